@@ -98,14 +98,23 @@ class RequirementUnderstandingLayer:
         while True:
             if not self.input_queue.empty():
                 user_input = self.input_queue.get()
-                processed_data = self.send_to_llm(user_input)
-                knowledge_data = self.query_knowledge_base(user_input)
-                if knowledge_data:
-                    processed_data = self.enhance_task_description(processed_data, knowledge_data)
-                
-                self.log_interaction(user_input, processed_data)
-                self.tdd.add(self.create_tdd(processed_data, knowledge_data))
-                
+                self.process_input(user_input)
+
+    def process_input(self, user_input: str, keep: bool = True) -> dict:
+        """
+        Parse a single user input into a TDD and log it, keep it in memory unless keep is False.
+        """
+        processed_data = self.send_to_llm(user_input)
+        knowledge_data = self.query_knowledge_base(user_input) or []
+        if knowledge_data:
+            processed_data = self.enhance_task_description(processed_data, knowledge_data)
+
+        self.log_interaction(user_input, json.dumps(processed_data, ensure_ascii=False))
+        tdd = self.create_tdd(processed_data, knowledge_data)
+        if keep:
+            self.tdd.append(tdd)
+        return tdd
+
 
     def enhance_task_description(self, llm_output: str, knowledge_data: list) -> str:
         """
@@ -137,9 +146,8 @@ class RequirementUnderstandingLayer:
 
     def send_to_llm(self, user_input: str) -> dict:
         retry_times = self.ru_config.get('retry_times', 5)
+        except_info = None
         while retry_times > 0:
-            except_info = None
-            format_error = False
             try:
                 if except_info is not None:
                     self.dialogs.append({"role": "user", "content": except_info})
@@ -159,7 +167,10 @@ class RequirementUnderstandingLayer:
                 )
                 formated_response =  response.choices[0].message.content.strip()
             except Exception as e:
-                print(f"Error communicating with LLM: {e}")
+                logger.error(f"Error communicating with LLM: {e}")
+                # Drop the unanswered message so the retry doesn't append it to the dialog twice
+                self.dialogs.pop()
+                retry_times -= 1
                 continue
             try:
                 response_data = json.loads(formated_response)
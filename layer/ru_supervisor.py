@@ -0,0 +1,394 @@
+import os
+import time
+import zlib
+import sqlite3
+import queue
+import logging
+import threading
+
+from collections import OrderedDict, deque
+from multiprocessing import Process, Pipe
+from multiprocessing.connection import Connection, wait
+from typing import Deque, List, Optional, Tuple
+
+from layer.ru import RequirementUnderstandingLayer
+
+# Configure logger
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def ru_worker(worker_id: int, api_key: str, llm_server_url: str, llm_server_config: dict, ru_config: dict,
+              conn: Connection, layer_cls: type = RequirementUnderstandingLayer):
+    """
+    Worker process entry: owns its own RequirementUnderstandingLayer (LLM client + SQLite connection)
+    and keeps a separate dialog history for every session routed to it. Sessions beyond
+    ru_config['max_sessions'] are evicted least recently used first, and each dialog keeps only its
+    last ru_config['max_dialog_len'] messages. Inputs arrive and results leave over a private pipe
+    to the supervisor, one input at a time.
+    """
+    ru_layer = layer_cls(api_key, llm_server_url, llm_server_config, ru_config)
+    session_dialogs: OrderedDict[str, List] = OrderedDict()
+    max_sessions = ru_config.get('max_sessions', 256)
+    max_dialog_len = ru_config.get('max_dialog_len', 40)
+    logger.info(f"RU worker {worker_id} started.")
+
+    while True:
+        item = conn.recv()
+        if item is None:
+            break
+        session_key, user_input = item
+        ru_layer.dialogs = session_dialogs.setdefault(session_key, [])
+        session_dialogs.move_to_end(session_key)
+        if len(session_dialogs) > max_sessions:
+            session_dialogs.popitem(last=False)
+        try:
+            tdd = ru_layer.process_input(user_input, keep=False)
+        except Exception as e:
+            logger.error(f"RU worker {worker_id} failed on session {session_key}: {e}")
+            tdd = None
+        if len(ru_layer.dialogs) > max_dialog_len:
+            del ru_layer.dialogs[:-max_dialog_len]
+        conn.send((session_key, user_input, tdd))
+
+    ru_layer.db_connection.close()
+    logger.info(f"RU worker {worker_id} stopped.")
+
+
+class RequirementUnderstandingSupervisor:
+    """
+    Run N RequirementUnderstandingLayer worker processes and shard user inputs by session key.
+    Every session always lands on the same worker, so its messages are handled in order, while
+    different sessions are processed in parallel. Results of all workers go to one shared result queue,
+    a tdd of None marks an input whose processing failed.
+
+    The supervisor keeps each shard's pending inputs itself and hands them to the worker one at a time
+    over a per-worker pipe. A restarted worker gets a fresh pipe, so a process killed while holding a
+    pipe or queue lock can never stall its replacement or the other workers.
+    """
+    def __init__(self, api_key: str, llm_server_url: str, llm_server_config: dict, ru_config: dict,
+                 layer_cls: type = RequirementUnderstandingLayer):
+        self.api_key = api_key
+        self.llm_server_url = llm_server_url
+        self.llm_config = llm_server_config
+        self.ru_config = ru_config
+        self.layer_cls = layer_cls
+        self.num_workers = ru_config.get('num_workers', 4)
+        self.monitor_interval = ru_config.get('monitor_interval', 1.0)
+        self.worker_queue_size = ru_config.get('worker_queue_size', 20)
+        self.max_restarts = ru_config.get('max_restarts', 5)
+        self.max_restart_backoff = ru_config.get('max_restart_backoff', 30.0)
+        self.backlogs: List[Deque[Tuple[str, str]]] = [deque() for _ in range(self.num_workers)]
+        # Input currently handed to each worker, None while the worker is idle
+        self.in_flight: List[Optional[Tuple[str, str]]] = [None] * self.num_workers
+        self.conns: List[Optional[Connection]] = [None] * self.num_workers
+        self.result_queue = queue.Queue()
+        self.workers: List[Optional[Process]] = [None] * self.num_workers
+        # Consecutive crashes without a delivered result, and when the pending restart is due
+        self.restart_failures = [0] * self.num_workers
+        self.restart_at: List[Optional[float]] = [None] * self.num_workers
+        self.given_up = [False] * self.num_workers
+        self.running = False
+        self.dispatch_thread = None
+        self.lock = threading.Lock()
+        self.not_full = threading.Condition(self.lock)
+
+    def start(self):
+        with self.lock:
+            self.running = True
+            for worker_id in range(self.num_workers):
+                self.start_worker(worker_id)
+        self.dispatch_thread = threading.Thread(target=self.dispatch_results, daemon=True)
+        self.dispatch_thread.start()
+
+    def start_worker(self, worker_id: int):
+        parent_conn, child_conn = Pipe()
+        worker = Process(
+            target=ru_worker,
+            args=(worker_id, self.api_key, self.llm_server_url, self.llm_config, self.ru_config, child_conn,
+                  self.layer_cls),
+            daemon=True
+        )
+        worker.start()
+        child_conn.close()
+        self.conns[worker_id] = parent_conn
+        self.workers[worker_id] = worker
+        self.in_flight[worker_id] = None
+        self.send_next(worker_id)
+
+    def send_next(self, worker_id: int):
+        """
+        Hand the next pending input of the shard to its worker if the worker is idle. Caller holds the lock.
+        """
+        if self.conns[worker_id] is None or self.in_flight[worker_id] is not None or not self.backlogs[worker_id]:
+            return
+        item = self.backlogs[worker_id].popleft()
+        self.in_flight[worker_id] = item
+        self.not_full.notify_all()
+        try:
+            self.conns[worker_id].send(item)
+        except (BrokenPipeError, OSError):
+            # The worker is gone, restart_dead_workers takes care of the item
+            pass
+
+    def dispatch_results(self):
+        """
+        Fan in the results of all worker pipes into the shared result queue and restart dead workers.
+        """
+        while self.running:
+            with self.lock:
+                conns = {conn: worker_id for worker_id, conn in enumerate(self.conns) if conn is not None}
+            for conn in wait(list(conns), timeout=self.monitor_interval):
+                worker_id = conns[conn]
+                try:
+                    result = conn.recv()
+                except (EOFError, OSError):
+                    continue
+                with self.lock:
+                    if self.conns[worker_id] is not conn:
+                        continue
+                    self.in_flight[worker_id] = None
+                    self.restart_failures[worker_id] = 0
+                    self.result_queue.put(result)
+                    self.send_next(worker_id)
+            self.restart_dead_workers()
+
+    def restart_dead_workers(self):
+        """
+        Restart every worker process that exited unexpectedly, on a fresh pipe. The input being processed
+        at the moment of the crash is reported as failed, the ones still pending for that shard go to the new worker.
+        Consecutive crashes back off exponentially, after max_restarts of them the shard is given up and
+        its inputs are reported as failed.
+        """
+        with self.lock:
+            if not self.running:
+                return
+            now = time.monotonic()
+            for worker_id, worker in enumerate(self.workers):
+                if worker is None or worker.is_alive() or self.given_up[worker_id]:
+                    continue
+                if self.restart_at[worker_id] is None:
+                    self.handle_worker_exit(worker_id, now)
+                elif now >= self.restart_at[worker_id]:
+                    self.restart_at[worker_id] = None
+                    self.start_worker(worker_id)
+
+    def handle_worker_exit(self, worker_id: int, now: float):
+        """
+        Clean up after a dead worker and schedule its restart. Caller holds the lock.
+        """
+        worker = self.workers[worker_id]
+        worker.join()
+        self.conns[worker_id].close()
+        self.conns[worker_id] = None
+        if self.in_flight[worker_id] is not None:
+            session_key, user_input = self.in_flight[worker_id]
+            self.result_queue.put((session_key, user_input, None))
+            self.in_flight[worker_id] = None
+
+        self.restart_failures[worker_id] += 1
+        failures = self.restart_failures[worker_id]
+        if failures > self.max_restarts:
+            logger.error(f"RU worker {worker_id} exited {failures} times in a row (last code {worker.exitcode}), "
+                         f"giving up on its shard.")
+            self.given_up[worker_id] = True
+            self.fail_backlog(worker_id)
+            return
+        delay = min(self.monitor_interval * 2 ** (failures - 1), self.max_restart_backoff)
+        if failures == 1:
+            logger.warning(f"RU worker {worker_id} exited with code {worker.exitcode}, restarting.")
+        else:
+            logger.debug(f"RU worker {worker_id} exited with code {worker.exitcode}, restarting in {delay:.1f}s.")
+        self.restart_at[worker_id] = now + delay
+
+    def fail_backlog(self, worker_id: int):
+        while self.backlogs[worker_id]:
+            session_key, user_input = self.backlogs[worker_id].popleft()
+            self.result_queue.put((session_key, user_input, None))
+        self.not_full.notify_all()
+
+    def shard_of(self, session_key: str) -> int:
+        # crc32 is stable across processes, unlike the salted built-in hash()
+        return zlib.crc32(str(session_key).encode('utf-8')) % self.num_workers
+
+    def submit(self, session_key: str, user_input: str, timeout: Optional[float] = None):
+        """
+        Queue a user input for its session's worker. Blocks while the shard already has worker_queue_size
+        pending inputs and raises queue.Full if that lasts longer than timeout.
+        """
+        worker_id = self.shard_of(session_key)
+        with self.not_full:
+            # The shard may be given up while this call waits for room, so check it after waiting too
+            if not self.not_full.wait_for(
+                    lambda: self.given_up[worker_id] or len(self.backlogs[worker_id]) < self.worker_queue_size, timeout):
+                raise queue.Full
+            if self.given_up[worker_id]:
+                self.result_queue.put((session_key, user_input, None))
+                return
+            self.backlogs[worker_id].append((session_key, user_input))
+            self.send_next(worker_id)
+
+    def get_result(self, timeout: Optional[float] = None) -> Optional[Tuple[str, str, Optional[dict]]]:
+        """
+        Get the next (session_key, user_input, tdd) result from any worker, None on timeout.
+        tdd is None when the worker raised or died while processing the input.
+        """
+        try:
+            return self.result_queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def stop(self, timeout: float = 5.0):
+        """
+        Stop all workers. Inputs a worker finished before exiting are still delivered, every input
+        left pending or interrupted is reported with a None tdd.
+        """
+        with self.lock:
+            self.running = False
+        if self.dispatch_thread is not None:
+            self.dispatch_thread.join()
+        for conn in self.conns:
+            if conn is None:
+                continue
+            try:
+                conn.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+        for worker_id, worker in enumerate(self.workers):
+            if worker is None:
+                continue
+            worker.join(timeout)
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+            conn = self.conns[worker_id]
+            if conn is None:
+                continue
+            try:
+                while conn.poll():
+                    self.result_queue.put(conn.recv())
+                    self.in_flight[worker_id] = None
+            except (EOFError, OSError):
+                pass
+            conn.close()
+            self.conns[worker_id] = None
+
+        with self.lock:
+            for worker_id in range(self.num_workers):
+                if self.in_flight[worker_id] is not None:
+                    session_key, user_input = self.in_flight[worker_id]
+                    self.result_queue.put((session_key, user_input, None))
+                    self.in_flight[worker_id] = None
+                self.fail_backlog(worker_id)
+
+
+class StubLayer:
+    """
+    Stand-in for RequirementUnderstandingLayer in test(), without LLM or knowledge base.
+    "raise" raises, "crash" kills the worker process, "slow" takes a while, anything else is echoed back.
+    """
+    def __init__(self, api_key: str, llm_server_url: str, llm_server_config: dict, ru_config: dict):
+        self.dialogs = []
+        self.db_connection = sqlite3.connect(':memory:')
+
+    def process_input(self, user_input: str, keep: bool = True) -> dict:
+        if user_input == "raise":
+            raise ValueError("stub failure")
+        if user_input == "crash":
+            os._exit(1)
+        if user_input == "slow":
+            time.sleep(0.5)
+        self.dialogs.append({"role": "user", "content": user_input})
+        return {"intent": user_input, "details": len(self.dialogs)}
+
+
+class BrokenStubLayer(StubLayer):
+    def __init__(self, api_key: str, llm_server_url: str, llm_server_config: dict, ru_config: dict):
+        raise sqlite3.OperationalError("unable to open database file")
+
+
+def collect_results(supervisor: RequirementUnderstandingSupervisor, count: int, timeout: float = 5.0) -> list:
+    results = []
+    for _ in range(count):
+        result = supervisor.get_result(timeout)
+        assert result is not None, f"Only {len(results)} of {count} results arrived"
+        results.append(result)
+    return results
+
+
+def test():
+    ru_config = {'num_workers': 2, 'monitor_interval': 0.05, 'max_restarts': 2}
+
+    # 同一会话内按提交顺序处理，且每个会话拥有独立的对话历史
+    supervisor = RequirementUnderstandingSupervisor("", "", {}, ru_config, layer_cls=StubLayer)
+    supervisor.start()
+    sessions = [f"session_{i}" for i in range(4)]
+    for step in range(5):
+        for session_key in sessions:
+            supervisor.submit(session_key, f"{session_key}_msg_{step}")
+    results = collect_results(supervisor, 20)
+    for session_key in sessions:
+        session_results = [result for result in results if result[0] == session_key]
+        assert [result[1] for result in session_results] == [f"{session_key}_msg_{step}" for step in range(5)]
+        assert [result[2]["details"] for result in session_results] == [1, 2, 3, 4, 5]
+
+    # 处理异常时返回 None，worker 继续工作
+    supervisor.submit("session_0", "raise")
+    supervisor.submit("session_0", "after_raise")
+    assert collect_results(supervisor, 2) == [("session_0", "raise", None),
+                                              ("session_0", "after_raise", {"intent": "after_raise", "details": 6})]
+
+    # worker 崩溃时返回 None，重启后继续处理后续输入
+    worker_id = supervisor.shard_of("session_0")
+    crashed_pid = supervisor.workers[worker_id].pid
+    supervisor.submit("session_0", "crash")
+    supervisor.submit("session_0", "after_crash")
+    assert collect_results(supervisor, 2) == [("session_0", "crash", None),
+                                              ("session_0", "after_crash", {"intent": "after_crash", "details": 1})]
+    assert supervisor.workers[worker_id].pid != crashed_pid
+
+    # stop() 交付已完成的输入，其余输入返回 None
+    supervisor.submit("session_0", "slow")
+    supervisor.submit("session_0", "pending_1")
+    supervisor.submit("session_0", "pending_2")
+    time.sleep(0.1)
+    supervisor.stop()
+    results = collect_results(supervisor, 3)
+    assert results[0][1] == "slow" and results[0][2] is not None
+    assert results[1:] == [("session_0", "pending_1", None), ("session_0", "pending_2", None)]
+    assert supervisor.get_result(0.1) is None
+
+    # 启动反复失败后放弃该分片，所有待处理输入返回 None
+    supervisor = RequirementUnderstandingSupervisor(
+        "", "", {}, {'num_workers': 1, 'monitor_interval': 0.05, 'max_restarts': 2}, layer_cls=BrokenStubLayer
+    )
+    supervisor.start()
+    for i in range(3):
+        supervisor.submit("session_0", f"input_{i}")
+    results = collect_results(supervisor, 3)
+    assert results == [("session_0", f"input_{i}", None) for i in range(3)]
+    with supervisor.lock:
+        assert supervisor.given_up[0] and supervisor.restart_failures[0] == 3
+    supervisor.submit("session_0", "input_3")
+    assert collect_results(supervisor, 1) == [("session_0", "input_3", None)]
+    supervisor.stop()
+
+    # 等待队列空位的输入在分片被放弃后同样返回 None，不会滞留
+    supervisor = RequirementUnderstandingSupervisor(
+        "", "", {}, {'num_workers': 1, 'monitor_interval': 0.05, 'max_restarts': 0, 'worker_queue_size': 1},
+        layer_cls=BrokenStubLayer
+    )
+    supervisor.start()
+    supervisor.submit("session_0", "input_1")
+    supervisor.submit("session_0", "input_2")
+    waiter = threading.Thread(target=supervisor.submit, args=("session_0", "input_3"))
+    waiter.start()
+    results = collect_results(supervisor, 3)
+    waiter.join()
+    assert sorted(results) == [("session_0", f"input_{i}", None) for i in range(1, 4)]
+    supervisor.stop()
+
+    print("RU supervisor self-check passed.")
+
+if __name__ == "__main__":
+    test()
@@ -3,18 +3,21 @@ import json
 import time
 import yaml
 import copy
+import queue
 import asyncio
+import threading
 import logging
 import websockets
 
 import openai
 from enum import Enum
-from multiprocessing import Process, Queue
+from multiprocessing import Process
 from typing import List, Optional, Any
 
 from utils.visualizer_tool import cprint, ctext
 from utils.parse_proto import TaskQueue, TaskInfo, TaskCommand, TaskFeedback, TaskStatus, CommandType
-from proto.task_message_pb2 import TaskRequest
+from utils.wire_frame import FrameBatcher, FrameError, decode_frame
+from proto.task_message_pb2 import TaskRequest, TaskLog
 from utils.prompt_space import RequirementAnalysisStatus, PromptSpace
 from layer.ru import RequirementUnderstandingLayer
 
@@ -25,11 +28,23 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-def user_interface(uri: str, llm_config: str):
+def user_interface(uri: str, llm_config: str, wire_config: Optional[dict] = None):
     # uri = "ws://your_websocket_server_url"  # Replace with your WebSocket server URL
     # uri = "ws://localhost:8765"  # Local WebSocket server URL for inter-process communication
 
-    user_mq = Queue(maxsize=20)
+    # Text websocket messages carry human chat, binary ones carry batched protobuf frames (utils/wire_frame.py).
+    # The listener runs on a thread of this process, so plain queue.Queue avoids pickling every record
+    user_mq = queue.Queue(maxsize=20)
+    frame_mq = queue.Queue(maxsize=20)
+    # Tagged ("log", TaskLog) / ("feedback", TaskFeedback) / ("command", TaskCommand) records
+    # to report back to the client, sent in batched binary frames
+    report_mq = queue.Queue(maxsize=256)
+    batcher = FrameBatcher(wire_config)
+    batch_handlers = {
+        "log": batcher.add_log,
+        "feedback": batcher.add_feedback,
+        "command": batcher.add_command
+    }
     dialogs: List = [
         []
     ]
@@ -41,13 +56,51 @@ def user_interface(uri: str, llm_config: str):
     with open(llm_config, 'r') as file:
         llm_params = yaml.safe_load(file)
         
+    def report(kind: str, record: Any):
+        try:
+            report_mq.put_nowait((kind, record, time.monotonic()))
+        except queue.Full:
+            logger.warning(f"Report queue full, dropping {kind} record.")
+
+    async def websocket_receiver(websocket):
+        # Never block the event loop on the queues: binary telemetry is dropped if the consumer falls behind,
+        # human chat is handed off on an executor thread so it waits for room instead of being lost
+        loop = asyncio.get_running_loop()
+        while True:
+            message = await websocket.recv()
+            if isinstance(message, bytes):
+                try:
+                    frame_mq.put_nowait(decode_frame(message))
+                except FrameError as e:
+                    logger.error(f"Invalid binary frame: {e}")
+                except queue.Full:
+                    logger.warning("Frame queue full, dropping binary frame.")
+            else:
+                await loop.run_in_executor(None, user_mq.put, message)
+
+    async def websocket_reporter(websocket):
+        while True:
+            while not batcher.should_flush():
+                try:
+                    kind, record, reported_at = report_mq.get_nowait()
+                except queue.Empty:
+                    break
+                try:
+                    batch_handlers[kind](record, reported_at)
+                except Exception as e:
+                    logger.error(f"Dropping invalid {kind} record: {e}")
+            if batcher.should_flush():
+                await websocket.send(batcher.flush())
+                # More records may be queued already, only sleep once the queue is drained
+                continue
+            wait_time = batcher.time_to_flush()
+            await asyncio.sleep(batcher.max_delay if wait_time is None else wait_time)
+
     async def websocket_listener():
         async with websockets.connect(uri) as websocket:
-            while True:
-                message = await websocket.recv()
-                user_mq.put(message)
+            await asyncio.gather(websocket_receiver(websocket), websocket_reporter(websocket))
 
-    asyncio.run(websocket_listener())
+    threading.Thread(target=asyncio.run, args=(websocket_listener(),), daemon=True).start()
 
     # llm client
     logger.info("Initializing OpenAI client.")
@@ -78,6 +131,15 @@ def user_interface(uri: str, llm_config: str):
     prologue_context = copy.deepcopy(dialogs[0])
 
     while True:
+        while not frame_mq.empty():
+            batch = frame_mq.get()
+            for command in batch.commands:
+                logger.info(f"Received command {command.command} for task {command.task_id}")
+            for feedback in batch.feedbacks:
+                logger.info(f"Received feedback for task {feedback.task_id}: {feedback.feedback_message}")
+            for log in batch.logs:
+                logger.info(f"Received log for task {log.task_id}: [{log.log_level}] {log.log_message}")
+
         if not user_mq.empty():
             
             retry_times = 5
@@ -185,6 +247,13 @@ def user_interface(uri: str, llm_config: str):
                 logger.error(f"[Error] Unknown intent: {response_data['intent']}")
 
             # TODO: 给用户输入进行反馈
+            details = response_data.get("details")
+            report("log", TaskLog(
+                task_id=str(details.get("task_id", "")) if isinstance(details, dict) else "",
+                log_level="INFO" if except_info is None else "ERROR",
+                log_message=response_data["intent"] if except_info is None else except_info,
+                timestamp=time.strftime("%Y-%m-%d %H:%M:%S")
+            ))
 
             # TODO: 保留正确的对话内容，进行下一次对话
             dialogs[0].append({"role": "assisstant", "content": response})
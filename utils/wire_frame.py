@@ -0,0 +1,216 @@
+import time
+import zlib
+import struct
+
+from typing import Optional, Union
+from google.protobuf.message import DecodeError
+
+from utils.parse_proto import TaskFeedback, TaskCommand, TaskStatus, CommandType
+from proto import task_message_pb2
+
+# Binary frame layout: | version (1 byte) | flags (1 byte) | payload (serialized TaskBatch) |
+# Text websocket messages are left untouched and stay the channel for human chat.
+FRAME_VERSION = 1
+FRAME_HEADER = struct.Struct(">BB")
+FLAG_ZLIB = 0x01
+# Upper bound of a decompressed payload, frames come from the network
+MAX_PAYLOAD_SIZE = 4 * 1024 * 1024
+
+
+class FrameError(ValueError):
+    pass
+
+
+def encode_frame(batch: task_message_pb2.TaskBatch, compress: bool = False, compress_threshold: int = 256) -> bytes:
+    """
+    Serialize a TaskBatch into a binary websocket frame, zlib-compressing payloads above the threshold.
+    """
+    payload = batch.SerializeToString()
+    flags = 0
+    if compress and len(payload) >= compress_threshold:
+        payload = zlib.compress(payload)
+        flags |= FLAG_ZLIB
+    return FRAME_HEADER.pack(FRAME_VERSION, flags) + payload
+
+
+def decode_frame(data: bytes, max_payload_size: int = MAX_PAYLOAD_SIZE) -> task_message_pb2.TaskBatch:
+    """
+    Parse a binary websocket frame into a TaskBatch, raising FrameError for any malformed frame.
+    """
+    if len(data) < FRAME_HEADER.size:
+        raise FrameError(f"Frame too short: {len(data)} bytes")
+    version, flags = FRAME_HEADER.unpack_from(data)
+    if version != FRAME_VERSION:
+        raise FrameError(f"Unsupported frame version: {version}")
+    payload = data[FRAME_HEADER.size:]
+    if flags & FLAG_ZLIB:
+        decompressor = zlib.decompressobj()
+        try:
+            payload = decompressor.decompress(payload, max_payload_size)
+        except zlib.error as e:
+            raise FrameError(f"Frame decompression failed: {e}")
+        if decompressor.unconsumed_tail:
+            raise FrameError(f"Decompressed payload exceeds {max_payload_size} bytes")
+        if not decompressor.eof:
+            raise FrameError("Truncated compressed payload")
+    elif len(payload) > max_payload_size:
+        raise FrameError(f"Payload exceeds {max_payload_size} bytes")
+    batch = task_message_pb2.TaskBatch()
+    try:
+        batch.ParseFromString(payload)
+    except DecodeError as e:
+        raise FrameError(f"Frame payload parsing failed: {e}")
+    return batch
+
+
+def feedback_to_proto(feedback: TaskFeedback) -> task_message_pb2.TaskFeedback:
+    return task_message_pb2.TaskFeedback(
+        task_id=feedback.task_id,
+        status=feedback.status.value,
+        feedback_message=feedback.feedback_message,
+        end_at=feedback.end_at,
+        metrics=feedback.metrics
+    )
+
+
+def command_to_proto(command: TaskCommand) -> task_message_pb2.TaskCommand:
+    return task_message_pb2.TaskCommand(
+        task_id=command.task_id,
+        task_type=command.task_type,
+        command=command.command.name,
+        options=command.options
+    )
+
+
+class FrameBatcher:
+    """
+    Collect commands, feedbacks and logs and pack them into one binary frame once the batch
+    is full or the oldest pending record has waited longer than max_delay seconds.
+    """
+    def __init__(self, wire_config: Optional[dict] = None):
+        wire_config = wire_config or {}
+        self.max_batch_size = wire_config.get('max_batch_size', 64)
+        self.max_delay = wire_config.get('max_delay', 0.05)
+        self.compress = wire_config.get('compress', False)
+        self.compress_threshold = wire_config.get('compress_threshold', 256)
+        self.batch = task_message_pb2.TaskBatch()
+        self.pending = 0
+        self.first_added_at = None
+
+    def _added(self, added_at: Optional[float] = None):
+        # added_at is the time.monotonic() at which the record was produced, it defaults to now
+        added_at = time.monotonic() if added_at is None else added_at
+        if self.pending == 0 or added_at < self.first_added_at:
+            self.first_added_at = added_at
+        self.pending += 1
+
+    def add_command(self, command: Union[TaskCommand, task_message_pb2.TaskCommand], added_at: Optional[float] = None):
+        if isinstance(command, TaskCommand):
+            command = command_to_proto(command)
+        self.batch.commands.append(command)
+        self._added(added_at)
+
+    def add_feedback(self, feedback: Union[TaskFeedback, task_message_pb2.TaskFeedback],
+                     added_at: Optional[float] = None):
+        if isinstance(feedback, TaskFeedback):
+            feedback = feedback_to_proto(feedback)
+        self.batch.feedbacks.append(feedback)
+        self._added(added_at)
+
+    def add_log(self, log: task_message_pb2.TaskLog, added_at: Optional[float] = None):
+        self.batch.logs.append(log)
+        self._added(added_at)
+
+    def time_to_flush(self) -> Optional[float]:
+        """
+        Seconds left until the oldest pending record must be flushed, None if nothing is pending.
+        """
+        if self.pending == 0:
+            return None
+        if self.pending >= self.max_batch_size:
+            return 0.0
+        return max(0.0, self.first_added_at + self.max_delay - time.monotonic())
+
+    def should_flush(self) -> bool:
+        return self.time_to_flush() == 0.0
+
+    def flush(self) -> Optional[bytes]:
+        """
+        Encode all pending records into one frame and reset the batch, None if nothing is pending.
+        """
+        if self.pending == 0:
+            return None
+        frame = encode_frame(self.batch, self.compress, self.compress_threshold)
+        self.batch = task_message_pb2.TaskBatch()
+        self.pending = 0
+        self.first_added_at = None
+        return frame
+
+
+def expect_frame_error(data: bytes, **kwargs):
+    try:
+        decode_frame(data, **kwargs)
+    except FrameError:
+        return
+    raise AssertionError(f"Frame was not rejected: {data[:16]!r}")
+
+
+def test():
+    # 构造一个包含命令、反馈与日志的批次
+    batch = task_message_pb2.TaskBatch()
+    batch.commands.add(task_id="task_1", task_type="detection", command="START", options={"timeout": "60"})
+    batch.feedbacks.add(task_id="task_1", status=task_message_pb2.RUNNING, feedback_message="running" * 50)
+    batch.logs.add(task_id="task_1", log_level="INFO", log_message="model loaded", timestamp="2025-01-01 00:00:00")
+
+    # 压缩与不压缩的往返
+    plain_frame = encode_frame(batch)
+    assert plain_frame[1] & FLAG_ZLIB == 0
+    assert decode_frame(plain_frame) == batch
+    zlib_frame = encode_frame(batch, compress=True)
+    assert zlib_frame[1] & FLAG_ZLIB
+    assert len(zlib_frame) < len(plain_frame)
+    assert decode_frame(zlib_frame) == batch
+    assert encode_frame(batch, compress=True, compress_threshold=len(plain_frame))[1] & FLAG_ZLIB == 0
+
+    # 异常帧：版本错误、截断、损坏、解压超限
+    expect_frame_error(bytes([FRAME_VERSION + 1]) + plain_frame[1:])
+    expect_frame_error(plain_frame[:1])
+    expect_frame_error(plain_frame[:len(plain_frame) // 2])
+    expect_frame_error(b"\x01\x00\xff\xff\xff")
+    expect_frame_error(b"\x01\x01not zlib")
+    for cut in range(FRAME_HEADER.size, len(zlib_frame)):
+        expect_frame_error(zlib_frame[:cut])
+    expect_frame_error(zlib_frame, max_payload_size=16)
+    expect_frame_error(plain_frame, max_payload_size=16)
+
+    # 批次达到数量上限时刷新
+    batcher = FrameBatcher({'max_batch_size': 3, 'max_delay': 60})
+    assert batcher.flush() is None
+    batcher.add_command(TaskCommand("task_1", "detection", CommandType.STOP))
+    batcher.add_feedback(TaskFeedback("task_1", TaskStatus.COMPLETED, "done", "2025-01-01 00:01:00", {"fps": "30"}))
+    assert not batcher.should_flush()
+    batcher.add_log(task_message_pb2.TaskLog(task_id="task_1", log_level="INFO", log_message="stopped"))
+    assert batcher.should_flush()
+    flushed = decode_frame(batcher.flush())
+    assert flushed.commands[0].command == "STOP"
+    assert flushed.feedbacks[0].status == task_message_pb2.COMPLETED
+    assert flushed.feedbacks[0].metrics["fps"] == "30"
+    assert len(flushed.logs) == 1
+    assert batcher.pending == 0 and not batcher.should_flush()
+
+    # 最早的记录等待超过 max_delay 时刷新，等待时间从记录产生时开始计算
+    batcher = FrameBatcher({'max_batch_size': 64, 'max_delay': 0.05})
+    assert batcher.time_to_flush() is None
+    batcher.add_log(task_message_pb2.TaskLog(task_id="task_2", log_level="WARN", log_message="slow"))
+    assert not batcher.should_flush() and 0 < batcher.time_to_flush() <= 0.05
+    time.sleep(0.06)
+    assert batcher.should_flush()
+    assert len(decode_frame(batcher.flush()).logs) == 1
+    batcher.add_log(task_message_pb2.TaskLog(task_id="task_2", log_level="WARN", log_message="queued"),
+                    added_at=time.monotonic() - 0.05)
+    assert batcher.should_flush()
+
+    print("Frame codec self-check passed.")
+
+if __name__ == "__main__":
+    test()